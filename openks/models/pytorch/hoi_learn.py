@@ -4,9 +4,9 @@
 import logging
 import argparse
 import datetime
+import inspect
 import time
 import json
-from tqdm import tqdm
 import random
 from pathlib import Path
 
@@ -20,10 +20,195 @@ from ..model import VisualConstructionModel
 
 from .mmd_modules.HOI.engine import evaluate_hoi, train_one_epoch
 from .mmd_modules.HOI.models import build_model
+from .mmd_modules.HOI.models.tr_helper import use_sdpa_attention
 from .mmd_modules.HOI.datasets import build_dataset, get_coco_api_from_dataset
+from .mmd_modules.HOI.datasets.samplers import GroupedBatchSampler, create_aspect_ratio_groups
 from .mmd_modules.HOI.util import misc as utils
 
 
+def build_parser():
+    parser = argparse.ArgumentParser(description="HOI Relation Extraction Model")
+    parser.add_argument('--lr', default=1e-4, type=float)
+    parser.add_argument('--lr_backbone', default=1e-5, type=float)
+    parser.add_argument('--batch_size', default=1, type=int)
+    parser.add_argument('--weight_decay', default=1e-4, type=float)
+    parser.add_argument('--epochs', default=60, type=int)
+    parser.add_argument('--lr_drop', default=40, type=int)
+    parser.add_argument('--clip_max_norm', default=0.1, type=float,
+                        help='gradient clipping max norm')
+    parser.add_argument('--accum_steps', default=1, type=int,
+                        help='number of iterations to accumulate gradients over before an optimizer step')
+    parser.add_argument('--optimizer_impl', default='fused', type=str, choices=('fused', 'foreach', 'for-loop'),
+                        help="AdamW implementation, fused falls back to foreach if unavailable")
+    parser.add_argument('--zero_optim', action='store_true',
+                        help="Shard optimizer states across ranks with ZeroRedundancyOptimizer (distributed only)")
+    parser.add_argument('--amp_dtype', default='bfloat16', type=str, choices=('float32', 'bfloat16', 'float16'),
+                        help="Autocast dtype of the forward pass on cuda, float32 disables mixed precision")
+
+    # Model parameters
+    parser.add_argument('--frozen_weights', type=str, default=None,
+                        help="Path to the pretrained model. If set, only the mask head will be trained")
+    # * Backbone
+    parser.add_argument('--backbone', default='resnet50', type=str,
+                        help="Name of the convolutional backbone to use")
+    parser.add_argument('--dilation', action='store_true',
+                        help="If true, we replace stride with dilation in the last convolutional block (DC5)")
+    parser.add_argument('--no_channels_last', dest='channels_last', action='store_false',
+                        help="Keep the backbone weights and inputs in NCHW instead of channels-last")
+    parser.add_argument('--position_embedding', default='sine', type=str, choices=('sine', 'learned'),
+                        help="Type of positional embedding to use on top of the image features")
+
+    # * Transformer
+    parser.add_argument('--enc_layers', default=4, type=int,
+                        help="Number of encoding layers in the transformer")
+    parser.add_argument('--dec_layers', default=6, type=int,
+                        help="Number of decoding layers in the transformer")
+    parser.add_argument('--hoi_enc_layers', default=2, type=int,
+                        help="Number of hoi encoding layers in the transformer")
+    parser.add_argument('--hoi_dec_layers', default=0, type=int,
+                        help="Number of hoi decoding layers in the transformer")
+    parser.add_argument('--dim_feedforward', default=2048, type=int,
+                        help="Intermediate size of the feedforward layers in the transformer blocks")
+    parser.add_argument('--dim_feedforward_hoi', default=2048, type=int,
+                        help="Intermediate size of the feedforward layers in the hoi transformer blocks")
+    parser.add_argument('--hidden_dim', default=256, type=int,
+                        help="Size of the embeddings (dimension of the transformer)")
+    parser.add_argument('--dropout', default=0.1, type=float,
+                        help="Dropout applied in the transformer")
+    parser.add_argument('--nheads', default=8, type=int,
+                        help="Number of attention heads inside the transformer's attentions")
+    parser.add_argument('--nheads_hoi', default=8, type=int,
+                        help="Number of attention heads inside the hoi transformer's attentions")
+    parser.add_argument('--num_queries', default=100, type=int,
+                        help="Number of query slots")
+    parser.add_argument('--pre_norm', action='store_true')
+    parser.add_argument('--grad_checkpoint', action='store_true',
+                        help="Recompute transformer layer activations in backward to save memory")
+    parser.add_argument('--compile', action='store_true',
+                        help="Compile the model with torch.compile (cuda only)")
+    parser.add_argument('--no_sdpa', dest='sdpa', action='store_false',
+                        help="Disables F.scaled_dot_product_attention in the transformer attentions")
+
+    # hoi encoder/decoder
+    parser.add_argument('--load_bottleneck_dec_ca_weights', action='store_true')
+    parser.add_argument('--hoi_enc_type', type=str, default='hoi_bottleneck')
+    parser.add_argument('--vanilla_dec_type', type=str, default='vanilla_bottleneck')
+    parser.add_argument('--hoi_dec_type', type=str, default='vanilla')
+
+    # * Segmentation
+    parser.add_argument('--masks', action='store_true',
+                        help="Train segmentation head if the flag is provided")
+
+    # HOI
+    parser.add_argument('--hoi', action='store_true',
+                        help="Train for HOI if the flag is provided")
+    parser.add_argument('--num_obj_classes', type=int, default=80,
+                        help="Number of object classes")
+    parser.add_argument('--num_verb_classes', type=int, default=117,
+                        help="Number of verb classes")
+    parser.add_argument('--pretrained', type=str, default='hoi_params/detr-r50-pre.pth',
+                        help='Pretrained model path')
+    parser.add_argument('--subject_category_id', default=0, type=int)
+    parser.add_argument('--verb_loss_type', type=str, default='focal',
+                        help='Loss type for the verb classification')
+    parser.add_argument('--verb_gamma', type=float, default=2)
+    parser.add_argument('--verb_alpha', type=float, default=None)
+
+    parser.add_argument('--split_query', action='store_true',
+                        help="use splitted queries for different branches")
+    parser.add_argument('--interact_query', action='store_true',
+                        help="interact between different query branches")
+
+    # Loss
+    parser.add_argument('--no_aux_loss', dest='aux_loss', action='store_false',
+                        help="Disables auxiliary decoding losses (loss at each layer)")
+    parser.add_argument('--use_matching', action='store_true',
+                        help="Use obj/sub matching 2class loss in first decoder, default not use")
+
+    # * Matcher
+    parser.add_argument('--set_cost_class', default=1, type=float,
+                        help="Class coefficient in the matching cost")
+    parser.add_argument('--set_cost_bbox', default=2.5, type=float,
+                        help="L1 box coefficient in the matching cost")
+    parser.add_argument('--set_cost_giou', default=1, type=float,
+                        help="giou box coefficient in the matching cost")
+    parser.add_argument('--set_cost_obj_class', default=1, type=float,
+                        help="Object class coefficient in the matching cost")
+    parser.add_argument('--set_cost_verb_class', default=1, type=float,
+                        help="Verb class coefficient in the matching cost")
+    parser.add_argument('--box_matcher', default='split_max', type=str)
+    parser.add_argument('--set_cost_matching', default=1, type=float,
+                        help="Sub and obj box matching coefficient in the matching cost")
+
+    # * Loss coefficients
+    parser.add_argument('--mask_loss_coef', default=1, type=float)
+    parser.add_argument('--dice_loss_coef', default=1, type=float)
+    parser.add_argument('--bbox_loss_coef', default=2.5, type=float)
+    parser.add_argument('--giou_loss_coef', default=1, type=float)
+    parser.add_argument('--obj_loss_coef', default=1, type=float)
+    parser.add_argument('--verb_loss_coef', default=1, type=float)
+    parser.add_argument('--eos_coef', default=0.1, type=float,
+                        help="Relative classification weight of the no-object class")
+
+    # dataset parameters
+    parser.add_argument('--dataset_file', default='hico')
+    parser.add_argument('--coco_path', type=str)
+    parser.add_argument('--coco_panoptic_path', type=str)
+    parser.add_argument('--remove_difficult', action='store_true')
+    parser.add_argument('--hoi_path', type=str, default='data/hico_20160224_det')
+
+    parser.add_argument('--output_dir', default='logs_hoi',
+                        help='path where to save, empty for no saving')
+    parser.add_argument('--device', default='cuda',
+                        help='device to use for training / testing')
+    parser.add_argument('--seed', default=42, type=int)
+    parser.add_argument('--cudnn_benchmark', action='store_true',
+                        help='let cudnn autotune conv algorithms, only useful with fixed input sizes')
+    parser.add_argument('--cudnn_deterministic', action='store_true',
+                        help='disable cudnn benchmark and TF32 for reproducible runs')
+    parser.add_argument('--resume', default='', help='resume from checkpoint')
+    parser.add_argument('--start_epoch', default=0, type=int, metavar='N',
+                        help='start epoch')
+    parser.add_argument('--eval', action='store_true')
+    parser.add_argument('--log_interval', default=50, type=int,
+                        help='update training meters and print every N iterations')
+    parser.add_argument('--eval_interval', default=5, type=int,
+                        help='evaluate every N epochs during training, the last epoch is always evaluated')
+    parser.add_argument('--num_workers', default=4, type=int)
+
+    # distributed training parameters
+    parser.add_argument('--world_size', default=1, type=int,
+                        help='number of distributed processes')
+    parser.add_argument('--dist_url', default='env://', help='url used to set up distributed training')
+    parser.add_argument('--ddp_find_unused', action='store_true',
+                        help='let DDP search for unused parameters, only needed if some heads are skipped')
+
+    # decoupling training parameters
+    parser.add_argument('--freeze_mode', default=0, type=int)
+    parser.add_argument('--obj_reweight', action='store_true')
+    parser.add_argument('--verb_reweight', action='store_true')
+    parser.add_argument('--use_static_weights', action='store_true',
+                        help='use static weights or dynamic weights, default use dynamic')
+    parser.add_argument('--queue_size', default=4704 * 1.0, type=float,
+                        help='Maxsize of queue for obj and verb reweighting, default 1 epoch')
+    parser.add_argument('--p_obj', default=0.7, type=float,
+                        help='Reweighting parameter for obj')
+    parser.add_argument('--p_verb', default=0.7, type=float,
+                        help='Reweighting parameter for verb')
+
+    # hoi eval parameters
+    parser.add_argument('--use_nms_filter', action='store_true', help='Use pair nms filter, default not use')
+    parser.add_argument('--thres_nms', default=0.7, type=float)
+    parser.add_argument('--nms_alpha', default=1.0, type=float)
+    parser.add_argument('--nms_beta', default=0.5, type=float)
+    parser.add_argument('--json_file', default='results.json', type=str)
+    return parser
+
+
+# the parser is only built once and reused by every instance
+_PARSER = build_parser()
+
+
 @VisualConstructionModel.register("HOI", "PyTorch")
 class VisualRelationTorch(VisualConstructionModel):
     # TODO distributed learning is not complete.
@@ -37,234 +222,185 @@ class VisualRelationTorch(VisualConstructionModel):
 
         # set the device we need to use
         self.device = torch.device(self.args.device)
+        # use TF32 tensor cores unless reproducibility is required. cudnn autotuning is opt-in:
+        # the random resizes / crops give almost every batch a new shape, retuning each time
+        deterministic = self.args.cudnn_deterministic
+        torch.backends.cudnn.benchmark = self.args.cudnn_benchmark and not deterministic
+        torch.backends.cudnn.deterministic = deterministic
+        torch.backends.cuda.matmul.allow_tf32 = not deterministic
+        torch.backends.cudnn.allow_tf32 = not deterministic
+        if hasattr(torch, 'set_float32_matmul_precision'):
+            torch.set_float32_matmul_precision('highest' if deterministic else 'high')
         # fix the random seed
-        seed = self.args.seed + utils.get_rank()
+        seed = self.seed = self.args.seed + utils.get_rank()
         torch.manual_seed(seed)
         np.random.seed(seed)
         random.seed(seed)
 
+        # mixed precision is only used on cuda, fp16 additionally needs loss scaling
+        self.amp_dtype = None
+        if self.device.type == 'cuda' and self.args.amp_dtype != 'float32':
+            self.amp_dtype = getattr(torch, self.args.amp_dtype)
+            if self.amp_dtype == torch.bfloat16 and not hasattr(torch, 'autocast'):
+                # torch < 1.10 has no bf16 autocast, use fp16 with loss scaling instead
+                print('bfloat16 autocast is not supported by this torch version, using float16')
+                self.amp_dtype = torch.float16
+        self.scaler = torch.cuda.amp.GradScaler(enabled=self.amp_dtype == torch.float16)
+
         # build model
         self.model, self.criterion, self.postprocessors = build_model(self.args)
+        if self.args.sdpa:
+            print('attention layers using sdpa:', use_sdpa_attention(self.model))
         self.model.to(self.device)
+        # NHWC lets cudnn pick tensor core kernels for the backbone convolutions
+        self.memory_format = torch.channels_last if self.args.channels_last else torch.preserve_format
+        self.model.to(memory_format=self.memory_format)
         self.model_without_ddp = self.model
         if self.args.distributed:
+            ddp_kwargs = dict(find_unused_parameters=self.args.ddp_find_unused, bucket_cap_mb=50,
+                              gradient_as_bucket_view=True)
+            # static_graph is only accepted from torch 1.11 on
+            if 'static_graph' in inspect.signature(torch.nn.parallel.DistributedDataParallel).parameters:
+                ddp_kwargs['static_graph'] = True
             self.model = torch.nn.parallel.DistributedDataParallel(self.model, device_ids=[self.args.gpu],
-                                                                   find_unused_parameters=True)
+                                                                   **ddp_kwargs)
             self.model_without_ddp = self.model.module
-        self.n_parameters = sum(p.numel() for p in self.model.parameters() if p.requires_grad)
-        print('number of params:', self.n_parameters)
+        if self.args.compile and hasattr(torch, 'compile') and self.device.type == 'cuda':
+            # padded batch sizes change every iteration, compile with dynamic shapes once
+            # instead of recompiling (and autotuning) for each new input size.
+            # only the module used for forward is compiled, model_without_ddp keeps the plain state_dict keys
+            self.model = torch.compile(self.model, mode='default', dynamic=True)
 
-        # build optimizer
+        # build optimizer, splitting backbone / head parameters in a single pass
+        head_params, backbone_params = [], []
+        self.n_parameters = 0
+        for n, p in self.model_without_ddp.named_parameters():
+            if not p.requires_grad:
+                continue
+            (backbone_params if "backbone" in n else head_params).append(p)
+            self.n_parameters += p.numel()
+        print('number of params:', self.n_parameters)
         self.param_dicts = [
-            {"params": [p for n, p in self.model_without_ddp.named_parameters() if "backbone" not in n and p.requires_grad]},
-            {
-                "params": [p for n, p in self.model_without_ddp.named_parameters() if "backbone" in n and p.requires_grad],
-                "lr": self.args.lr_backbone,
-            },
+            {"params": head_params},
+            {"params": backbone_params, "lr": self.args.lr_backbone},
         ]
 
-        self.optimizer = torch.optim.AdamW(self.param_dicts, lr=self.args.lr, weight_decay=self.args.weight_decay)
-        self.lr_scheduler = torch.optim.lr_scheduler.StepLR(self.optimizer, self.args.lr_drop)
+        self.optimizer = self.build_optimizer()
 
         self.output_dir = Path(self.args.output_dir)
+        self._dataset_val = None
+        self._data_loader_val = None
         self.recorder = utils.RecorderHOI() if self.args.hoi else None
-        utils.load_model_weights(self.args, self.model_without_ddp, self.optimizer, self.lr_scheduler, self.recorder)
+        utils.load_model_weights(self.args, self.model_without_ddp, self.optimizer, recorder=self.recorder)
     
+    def build_optimizer(self):
+        # fused / foreach AdamW launch a few multi-tensor kernels instead of several per parameter
+        impl = self.args.optimizer_impl
+        if impl == 'fused' and self.device.type != 'cuda':
+            impl = 'foreach'
+        # for-loop has to be requested explicitly, AdamW otherwise defaults to foreach on cuda
+        fallbacks = {'fused': [{'fused': True}, {'foreach': True}], 'foreach': [{'foreach': True}],
+                     'for-loop': [{'foreach': False}]}
+        for impl_kwargs in fallbacks[impl]:
+            try:
+                return self.create_optimizer(**impl_kwargs)
+            except (TypeError, RuntimeError):
+                # implementation not available in this torch build
+                continue
+        return self.create_optimizer()
+
+    def create_optimizer(self, **kwargs):
+        if self.args.zero_optim and self.args.distributed:
+            # shard the AdamW moments across ranks
+            from torch.distributed.optim import ZeroRedundancyOptimizer
+            return ZeroRedundancyOptimizer(self.param_dicts, optimizer_class=torch.optim.AdamW,
+                                           lr=self.args.lr, weight_decay=self.args.weight_decay,
+                                           parameters_as_bucket_view=True, **kwargs)
+        return torch.optim.AdamW(self.param_dicts, lr=self.args.lr, weight_decay=self.args.weight_decay, **kwargs)
+
+    def adjust_learning_rate(self, epoch):
+        # closed form of StepLR(step_size=lr_drop, gamma=0.1) stepped once per epoch
+        factor = 0.1 ** (epoch // self.args.lr_drop)
+        for param_group, base_lr in zip(self.optimizer.param_groups, (self.args.lr, self.args.lr_backbone)):
+            param_group['lr'] = base_lr * factor
+
     def parse_args(self, args):
-        parser = argparse.ArgumentParser(description="HOI Relation Extraction Model")
-        parser.add_argument('--lr', default=1e-4, type=float)
-        parser.add_argument('--lr_backbone', default=1e-5, type=float)
-        parser.add_argument('--batch_size', default=1, type=int)
-        parser.add_argument('--weight_decay', default=1e-4, type=float)
-        parser.add_argument('--epochs', default=60, type=int)
-        parser.add_argument('--lr_drop', default=40, type=int)
-        parser.add_argument('--clip_max_norm', default=0.1, type=float,
-                            help='gradient clipping max norm')
-
-        # Model parameters
-        parser.add_argument('--frozen_weights', type=str, default=None,
-                            help="Path to the pretrained model. If set, only the mask head will be trained")
-        # * Backbone
-        parser.add_argument('--backbone', default='resnet50', type=str,
-                            help="Name of the convolutional backbone to use")
-        parser.add_argument('--dilation', action='store_true',
-                            help="If true, we replace stride with dilation in the last convolutional block (DC5)")
-        parser.add_argument('--position_embedding', default='sine', type=str, choices=('sine', 'learned'),
-                            help="Type of positional embedding to use on top of the image features")
-
-        # * Transformer
-        parser.add_argument('--enc_layers', default=4, type=int,
-                            help="Number of encoding layers in the transformer")
-        parser.add_argument('--dec_layers', default=6, type=int,
-                            help="Number of decoding layers in the transformer")
-        parser.add_argument('--hoi_enc_layers', default=2, type=int,
-                            help="Number of hoi encoding layers in the transformer")
-        parser.add_argument('--hoi_dec_layers', default=0, type=int,
-                            help="Number of hoi decoding layers in the transformer")
-        parser.add_argument('--dim_feedforward', default=2048, type=int,
-                            help="Intermediate size of the feedforward layers in the transformer blocks")
-        parser.add_argument('--dim_feedforward_hoi', default=2048, type=int,
-                            help="Intermediate size of the feedforward layers in the hoi transformer blocks")
-        parser.add_argument('--hidden_dim', default=256, type=int,
-                            help="Size of the embeddings (dimension of the transformer)")
-        parser.add_argument('--dropout', default=0.1, type=float,
-                            help="Dropout applied in the transformer")
-        parser.add_argument('--nheads', default=8, type=int,
-                            help="Number of attention heads inside the transformer's attentions")
-        parser.add_argument('--nheads_hoi', default=8, type=int,
-                            help="Number of attention heads inside the hoi transformer's attentions")
-        parser.add_argument('--num_queries', default=100, type=int,
-                            help="Number of query slots")
-        parser.add_argument('--pre_norm', action='store_true')
-
-        # hoi encoder/decoder
-        parser.add_argument('--load_bottleneck_dec_ca_weights', action='store_true')
-        parser.add_argument('--hoi_enc_type', type=str, default='hoi_bottleneck')
-        parser.add_argument('--vanilla_dec_type', type=str, default='vanilla_bottleneck')
-        parser.add_argument('--hoi_dec_type', type=str, default='vanilla')
-
-        # * Segmentation
-        parser.add_argument('--masks', action='store_true',
-                            help="Train segmentation head if the flag is provided")
-
-        # HOI
-        parser.add_argument('--hoi', action='store_true',
-                            help="Train for HOI if the flag is provided")
-        parser.add_argument('--num_obj_classes', type=int, default=80,
-                            help="Number of object classes")
-        parser.add_argument('--num_verb_classes', type=int, default=117,
-                            help="Number of verb classes")
-        parser.add_argument('--pretrained', type=str, default='hoi_params/detr-r50-pre.pth',
-                            help='Pretrained model path')
-        parser.add_argument('--subject_category_id', default=0, type=int)
-        parser.add_argument('--verb_loss_type', type=str, default='focal',
-                            help='Loss type for the verb classification')
-        parser.add_argument('--verb_gamma', type=float, default=2)
-        parser.add_argument('--verb_alpha', type=float, default=None)
-
-        parser.add_argument('--split_query', action='store_true',
-                            help="use splitted queries for different branches")
-        parser.add_argument('--interact_query', action='store_true',
-                            help="interact between different query branches")
-
-        # Loss
-        parser.add_argument('--no_aux_loss', dest='aux_loss', action='store_false',
-                            help="Disables auxiliary decoding losses (loss at each layer)")
-        parser.add_argument('--use_matching', action='store_true',
-                            help="Use obj/sub matching 2class loss in first decoder, default not use")
-
-        # * Matcher
-        parser.add_argument('--set_cost_class', default=1, type=float,
-                            help="Class coefficient in the matching cost")
-        parser.add_argument('--set_cost_bbox', default=2.5, type=float,
-                            help="L1 box coefficient in the matching cost")
-        parser.add_argument('--set_cost_giou', default=1, type=float,
-                            help="giou box coefficient in the matching cost")
-        parser.add_argument('--set_cost_obj_class', default=1, type=float,
-                            help="Object class coefficient in the matching cost")
-        parser.add_argument('--set_cost_verb_class', default=1, type=float,
-                            help="Verb class coefficient in the matching cost")
-        parser.add_argument('--box_matcher', default='split_max', type=str)
-        parser.add_argument('--set_cost_matching', default=1, type=float,
-                            help="Sub and obj box matching coefficient in the matching cost")
-
-        # * Loss coefficients
-        parser.add_argument('--mask_loss_coef', default=1, type=float)
-        parser.add_argument('--dice_loss_coef', default=1, type=float)
-        parser.add_argument('--bbox_loss_coef', default=2.5, type=float)
-        parser.add_argument('--giou_loss_coef', default=1, type=float)
-        parser.add_argument('--obj_loss_coef', default=1, type=float)
-        parser.add_argument('--verb_loss_coef', default=1, type=float)
-        parser.add_argument('--eos_coef', default=0.1, type=float,
-                            help="Relative classification weight of the no-object class")
-
-        # dataset parameters
-        parser.add_argument('--dataset_file', default='hico')
-        parser.add_argument('--coco_path', type=str)
-        parser.add_argument('--coco_panoptic_path', type=str)
-        parser.add_argument('--remove_difficult', action='store_true')
-        parser.add_argument('--hoi_path', type=str, default='data/hico_20160224_det')
-
-        parser.add_argument('--output_dir', default='logs_hoi',
-                            help='path where to save, empty for no saving')
-        parser.add_argument('--device', default='cuda',
-                            help='device to use for training / testing')
-        parser.add_argument('--seed', default=42, type=int)
-        parser.add_argument('--resume', default='', help='resume from checkpoint')
-        parser.add_argument('--start_epoch', default=0, type=int, metavar='N',
-                            help='start epoch')
-        parser.add_argument('--eval', action='store_true')
-        parser.add_argument('--num_workers', default=4, type=int)
-
-        # distributed training parameters
-        parser.add_argument('--world_size', default=1, type=int,
-                            help='number of distributed processes')
-        parser.add_argument('--dist_url', default='env://', help='url used to set up distributed training')
-
-        # decoupling training parameters
-        parser.add_argument('--freeze_mode', default=0, type=int)
-        parser.add_argument('--obj_reweight', action='store_true')
-        parser.add_argument('--verb_reweight', action='store_true')
-        parser.add_argument('--use_static_weights', action='store_true',
-                            help='use static weights or dynamic weights, default use dynamic')
-        parser.add_argument('--queue_size', default=4704 * 1.0, type=float,
-                            help='Maxsize of queue for obj and verb reweighting, default 1 epoch')
-        parser.add_argument('--p_obj', default=0.7, type=float,
-                            help='Reweighting parameter for obj')
-        parser.add_argument('--p_verb', default=0.7, type=float,
-                            help='Reweighting parameter for verb')
-
-        # hoi eval parameters
-        parser.add_argument('--use_nms_filter', action='store_true', help='Use pair nms filter, default not use')
-        parser.add_argument('--thres_nms', default=0.7, type=float)
-        parser.add_argument('--nms_alpha', default=1.0, type=float)
-        parser.add_argument('--nms_beta', default=0.5, type=float)
-        parser.add_argument('--json_file', default='results.json', type=str)
-        opt = parser.parse_args(args)
-        return opt
+        return _PARSER.parse_args(args)
     
+    def loader_kwargs(self):
+        # pinned host buffers allow the non-blocking H2D copies in the engine,
+        # prefetch_factor/persistent_workers are only accepted with worker processes
+        kwargs = dict(collate_fn=utils.collate_fn, num_workers=self.args.num_workers,
+                      pin_memory=self.device.type == 'cuda', worker_init_fn=utils.seed_worker,
+                      generator=torch.Generator().manual_seed(self.seed))
+        if self.args.num_workers > 0:
+            kwargs.update(persistent_workers=True, prefetch_factor=4)
+        return kwargs
+
+    @property
+    def dataset_val(self):
+        # parsing the annotation files is costly, share the val set between train() and evaluate()
+        if self._dataset_val is None:
+            self._dataset_val = build_dataset(image_set='val', args=self.args)
+        return self._dataset_val
+
+    @property
+    def data_loader_val(self):
+        # reused by every train() / evaluate() call, keeping its persistent workers alive
+        if self._data_loader_val is None:
+            dataset_val = self.dataset_val
+            if self.args.distributed:
+                sampler_val = DistributedSampler(dataset_val, shuffle=False)
+            else:
+                sampler_val = torch.utils.data.SequentialSampler(dataset_val)
+            self._data_loader_val = DataLoader(dataset_val, self.args.batch_size, sampler=sampler_val,
+                                               drop_last=False, **self.loader_kwargs())
+        return self._data_loader_val
+
     def evaluate(self):
-        dataset_val = build_dataset(image_set='val', args=self.args)
-        if self.args.distributed:
-            sampler_val = DistributedSampler(dataset_val, shuffle=False)
-        else:
-            sampler_val = torch.utils.data.SequentialSampler(dataset_val)
-        data_loader_val = DataLoader(dataset_val, self.args.batch_size, sampler=sampler_val,
-                                     drop_last=False, collate_fn=utils.collate_fn, num_workers=self.args.num_workers)
         test_stats = evaluate_hoi(self.args.dataset_file, self.model, self.postprocessors, 
-                                  data_loader_val, self.args.subject_category_id, self.device)
+                                  self.data_loader_val, self.args.subject_category_id, self.device,
+                                  memory_format=self.memory_format)
+        return test_stats
     
     def train(self):
         dataset_train = build_dataset(image_set='train', args=self.args)
-        dataset_val = build_dataset(image_set='val', args=self.args)
         if self.args.distributed:
             sampler_train = DistributedSampler(dataset_train)
-            sampler_val = DistributedSampler(dataset_val, shuffle=False)
         else:
-            sampler_train = torch.utils.data.RandomSampler(dataset_train)
-            sampler_val = torch.utils.data.SequentialSampler(dataset_val)
-        batch_sampler_train = torch.utils.data.BatchSampler(sampler_train, self.args.batch_size, drop_last=True)
-
-        data_loader_train = DataLoader(dataset_train, batch_sampler=batch_sampler_train,
-                                       collate_fn=utils.collate_fn, num_workers=self.args.num_workers)
-        data_loader_val = DataLoader(dataset_val, self.args.batch_size, sampler=sampler_val,
-                                     drop_last=False, collate_fn=utils.collate_fn, num_workers=self.args.num_workers)
+            sampler_train = torch.utils.data.RandomSampler(dataset_train,
+                                                           generator=torch.Generator().manual_seed(self.seed))
+        if hasattr(dataset_train, 'get_aspect_ratios'):
+            # batch images of similar aspect ratio together to reduce padding
+            group_ids = create_aspect_ratio_groups(dataset_train.get_aspect_ratios())
+            batch_sampler_train = GroupedBatchSampler(sampler_train, group_ids, self.args.batch_size)
+        else:
+            batch_sampler_train = torch.utils.data.BatchSampler(sampler_train, self.args.batch_size, drop_last=True)
+
+        data_loader_train = DataLoader(dataset_train, batch_sampler=batch_sampler_train, **self.loader_kwargs())
+        if self.device.type == 'cuda':
+            data_loader_train = utils.CUDAPrefetcher(data_loader_train, self.device, self.memory_format)
+        data_loader_val = self.data_loader_val
         
         print("开始训练")
         start_time = time.time()
         for epoch in range(self.args.start_epoch, self.args.epochs):
             if self.args.distributed:
                 sampler_train.set_epoch(epoch)
-    
+            self.adjust_learning_rate(epoch)
+
             train_stats = train_one_epoch(self.model, self.criterion, data_loader_train, self.optimizer, self.device, epoch,
-                                          self.args.clip_max_norm)
-            self.lr_scheduler.step()
+                                          self.args.clip_max_norm, scaler=self.scaler, amp_dtype=self.amp_dtype,
+                                          memory_format=self.memory_format, log_interval=self.args.log_interval,
+                                          accum_steps=self.args.accum_steps)
 
-            test_stats = evaluate_hoi(self.args.dataset_file, self.model, self.postprocessors, data_loader_val, 
-                                      self.args.subject_category_id, self.device)
+            test_stats = {}
+            if (epoch + 1) % self.args.eval_interval == 0 or epoch == self.args.epochs - 1:
+                test_stats = evaluate_hoi(self.args.dataset_file, self.model, self.postprocessors, data_loader_val,
+                                          self.args.subject_category_id, self.device, memory_format=self.memory_format)
             coco_evaluator = hoi_evaluator = None
             utils.save_checkpoints(self.args, self.output_dir, self.recorder, epoch, test_stats,
-                                   self.model_without_ddp, self.optimizer, self.lr_scheduler,
+                                   self.model_without_ddp, self.optimizer, lr_scheduler=None,
                                    hoi_evaluator=hoi_evaluator)
             utils.save_logs(self.args, train_stats, test_stats, epoch, self.n_parameters,
                             self.output_dir, coco_evaluator=coco_evaluator)
@@ -140,6 +140,15 @@ class HICODetection(torch.utils.data.Dataset):
 
         return img, target
 
+    def get_aspect_ratios(self):
+        aspect_ratios = []
+        for idx in self.ids:
+            # only the image header is parsed here
+            with Image.open(self.img_folder / self.annotations[idx]['file_name']) as img:
+                w, h = img.size
+            aspect_ratios.append(w / h)
+        return aspect_ratios
+
     def set_rare_hois(self, anno_file):
         with open(anno_file, 'r') as f:
             annotations = json.load(f)
@@ -34,14 +34,15 @@ class HICOEvaluator():
             object_ids = object_ids.ravel()
 
             if len(subject_ids) > 0:
-                object_labels = np.array([bboxes[object_id]['category_id'] for object_id in object_ids])
+                object_labels = img_preds['labels'][object_ids]
                 masks = correct_mat[verb_labels, object_labels]
                 hoi_scores *= masks
 
+                # select the top max_hois before building the dicts, a stable sort keeps ties in input order
+                top = np.argsort(-hoi_scores, kind='stable')[:self.max_hois]
                 hois = [{'subject_id': subject_id, 'object_id': object_id, 'category_id': category_id, 'score': score} for
-                        subject_id, object_id, category_id, score in zip(subject_ids, object_ids, verb_labels, hoi_scores)]
-                hois.sort(key=lambda k: (k.get('score', 0)), reverse=True)
-                hois = hois[:self.max_hois]
+                        subject_id, object_id, category_id, score in
+                        zip(subject_ids[top], object_ids[top], verb_labels[top], hoi_scores[top])]
             else:
                 hois = []
 
@@ -0,0 +1,61 @@
+"""
+Batch samplers grouping images of similar aspect ratio.
+
+Adapted from the torchvision detection references.
+"""
+from collections import defaultdict
+
+from torch.utils.data.sampler import BatchSampler, Sampler
+
+
+def create_aspect_ratio_groups(aspect_ratios):
+    # two buckets: portrait (w / h < 1) and landscape (w / h >= 1)
+    return [int(ar >= 1) for ar in aspect_ratios]
+
+
+class GroupedBatchSampler(BatchSampler):
+    """
+    Wraps another sampler to yield mini-batches whose elements all come from
+    the same group, so that collate_fn pads each batch to a similar shape.
+    The number of batches is len(sampler) // batch_size, matching
+    BatchSampler(drop_last=True) so that every distributed rank runs the
+    same number of iterations; to reach it, incomplete groups left at the
+    end are topped up with repeated indices of the same group.
+    Arguments:
+        sampler (Sampler): base sampler.
+        group_ids (list[int]): group id of each element of the dataset.
+        batch_size (int): size of mini-batch.
+    """
+
+    def __init__(self, sampler, group_ids, batch_size):
+        if not isinstance(sampler, Sampler):
+            raise ValueError(
+                "sampler should be an instance of "
+                "torch.utils.data.Sampler, but got sampler={}".format(sampler)
+            )
+        self.sampler = sampler
+        self.group_ids = group_ids
+        self.batch_size = batch_size
+
+    def __iter__(self):
+        buffer_per_group = defaultdict(list)
+
+        num_batches = 0
+        for idx in self.sampler:
+            group_id = self.group_ids[idx]
+            buffer_per_group[group_id].append(idx)
+            if len(buffer_per_group[group_id]) == self.batch_size:
+                yield buffer_per_group.pop(group_id)
+                num_batches += 1
+
+        expected_num_batches = len(self)
+        for group_id, buffer in sorted(buffer_per_group.items(), key=lambda x: -len(x[1])):
+            if num_batches >= expected_num_batches:
+                break
+            while len(buffer) < self.batch_size:
+                buffer.extend(buffer[:self.batch_size - len(buffer)])
+            yield buffer
+            num_batches += 1
+
+    def __len__(self):
+        return len(self.sampler) // self.batch_size
@@ -1,6 +1,7 @@
 """
 Train and eval functions used in main.py
 """
+import contextlib
 import math
 import os
 import sys
@@ -16,9 +17,31 @@ from .datasets.hico_eval import HICOEvaluator
 # from .datasets.vcoco_eval import VCOCOEvaluator
 
 
+def _to_float32(outputs):
+    if isinstance(outputs, torch.Tensor):
+        return outputs.float() if outputs.is_floating_point() else outputs
+    if isinstance(outputs, dict):
+        return {k: _to_float32(v) for k, v in outputs.items()}
+    if isinstance(outputs, (list, tuple)):
+        return type(outputs)(_to_float32(v) for v in outputs)
+    return outputs
+
+
+def _autocast(device, amp_dtype):
+    if amp_dtype is None:
+        return contextlib.nullcontext()
+    if hasattr(torch, 'autocast'):
+        return torch.autocast(device.type, dtype=amp_dtype)
+    # torch < 1.10 only provides fp16 autocast on cuda
+    return torch.cuda.amp.autocast()
+
+
 def train_one_epoch(model: torch.nn.Module, criterion: torch.nn.Module,
                     data_loader: Iterable, optimizer: torch.optim.Optimizer,
-                    device: torch.device, epoch: int, max_norm: float = 0):
+                    device: torch.device, epoch: int, max_norm: float = 0,
+                    scaler=None, amp_dtype: torch.dtype = None,
+                    memory_format: torch.memory_format = torch.preserve_format,
+                    log_interval: int = 10, accum_steps: int = 1):
     model.train()
     criterion.train()
     metric_logger = utils.MetricLogger(delimiter="  ")
@@ -28,52 +51,85 @@ def train_one_epoch(model: torch.nn.Module, criterion: torch.nn.Module,
     else:
         metric_logger.add_meter('obj_class_error', utils.SmoothedValue(window_size=1, fmt='{value:.2f}'))
     header = 'Epoch: [{}]'.format(epoch)
-    print_freq = 10
 
-    for samples, targets in metric_logger.log_every(data_loader, print_freq, header):
-        samples = samples.to(device)
-        targets = [{k: v.to(device) for k, v in t.items()} for t in targets]
-
-        outputs = model(samples)
-        loss_dict = criterion(outputs, targets)
-        weight_dict = criterion.weight_dict
-        losses = sum(loss_dict[k] * weight_dict[k] for k in loss_dict.keys() if k in weight_dict)
-
-        # reduce losses over all GPUs for logging purposes
-        loss_dict_reduced = utils.reduce_dict(loss_dict)
-        loss_dict_reduced_unscaled = {f'{k}_unscaled': v
-                                      for k, v in loss_dict_reduced.items()}
-        loss_dict_reduced_scaled = {k: v * weight_dict[k]
-                                    for k, v in loss_dict_reduced.items() if k in weight_dict}
-        losses_reduced_scaled = sum(loss_dict_reduced_scaled.values())
-
-        loss_value = losses_reduced_scaled.item()
-
-        if not math.isfinite(loss_value):
-            print("Loss is {}, stopping training".format(loss_value))
-            print(loss_dict_reduced)
-            sys.exit(1)
-
-        optimizer.zero_grad()
-        losses.backward()
-        if max_norm > 0:
-            torch.nn.utils.clip_grad_norm_(model.parameters(), max_norm)
-        optimizer.step()
-
-        metric_logger.update(loss=loss_value, **loss_dict_reduced_scaled, **loss_dict_reduced_unscaled)
-        if hasattr(criterion, 'loss_labels'):
-            metric_logger.update(class_error=loss_dict_reduced['class_error'])
-        else:
-            metric_logger.update(obj_class_error=loss_dict_reduced['obj_class_error'])
-        metric_logger.update(lr=optimizer.param_groups[0]["lr"])
+    optimizer.zero_grad(set_to_none=True)
+    for step, (samples, targets) in enumerate(metric_logger.log_every(data_loader, log_interval, header)):
+        samples = samples.to(device, non_blocking=True, memory_format=memory_format)
+        targets = [{k: v.to(device, non_blocking=True) for k, v in t.items()} for t in targets]
+
+        # gradients are accumulated over accum_steps iterations, DDP only
+        # all-reduces them on the iteration that steps the optimizer
+        update_step = (step + 1) % accum_steps == 0 or step == len(data_loader) - 1
+        sync_context = model.no_sync if not update_step and hasattr(model, 'no_sync') else contextlib.nullcontext
+
+        with sync_context():
+            with _autocast(device, amp_dtype):
+                outputs = model(samples)
+            if amp_dtype is not None:
+                # matching and losses stay in fp32, scipy cannot consume half precision costs
+                outputs = _to_float32(outputs)
+            loss_dict = criterion(outputs, targets)
+            weight_dict = criterion.weight_dict
+            losses = sum(loss_dict[k] * weight_dict[k] for k in loss_dict.keys() if k in weight_dict)
+            if accum_steps > 1:
+                losses = losses / accum_steps
+
+            if scaler is not None:
+                scaler.scale(losses).backward()
+            else:
+                losses.backward()
+
+        # reducing losses over all GPUs and .item() synchronize with the device,
+        # so the loss check and the meters are only updated on logging steps
+        log_step = step % log_interval == 0 or step == len(data_loader) - 1
+        if log_step:
+            loss_dict_reduced = utils.reduce_dict(loss_dict)
+            loss_dict_reduced_unscaled = {f'{k}_unscaled': v
+                                          for k, v in loss_dict_reduced.items()}
+            loss_dict_reduced_scaled = {k: v * weight_dict[k]
+                                        for k, v in loss_dict_reduced.items() if k in weight_dict}
+            losses_reduced_scaled = sum(loss_dict_reduced_scaled.values())
+
+            loss_value = losses_reduced_scaled.item()
+
+            if not math.isfinite(loss_value):
+                print("Loss is {}, stopping training".format(loss_value))
+                print(loss_dict_reduced)
+                sys.exit(1)
+
+        if update_step:
+            if scaler is not None:
+                if max_norm > 0:
+                    scaler.unscale_(optimizer)
+                    torch.nn.utils.clip_grad_norm_(model.parameters(), max_norm)
+                scaler.step(optimizer)
+                scaler.update()
+            else:
+                if max_norm > 0:
+                    torch.nn.utils.clip_grad_norm_(model.parameters(), max_norm)
+                optimizer.step()
+            optimizer.zero_grad(set_to_none=True)
+
+        if log_step:
+            metric_logger.update(loss=loss_value, **loss_dict_reduced_scaled, **loss_dict_reduced_unscaled)
+            if hasattr(criterion, 'loss_labels'):
+                metric_logger.update(class_error=loss_dict_reduced['class_error'])
+            else:
+                metric_logger.update(obj_class_error=loss_dict_reduced['obj_class_error'])
+            metric_logger.update(lr=optimizer.param_groups[0]["lr"])
     # gather the stats from all processes
     metric_logger.synchronize_between_processes()
     print("Averaged stats:", metric_logger)
     return {k: meter.global_avg for k, meter in metric_logger.meters.items()}
 
 
-@torch.no_grad()
-def evaluate_hoi(dataset_file, model, postprocessors, data_loader, subject_category_id, device):
+# inference_mode needs torch 1.9+, fall back to no_grad on older versions
+_inference_mode = getattr(torch, 'inference_mode', torch.no_grad)
+
+
+@_inference_mode()
+def evaluate_hoi(dataset_file, model, postprocessors, data_loader, subject_category_id, device,
+                 memory_format=torch.preserve_format):
     model.eval()
 
     metric_logger = utils.MetricLogger(delimiter="  ")
@@ -82,7 +138,7 @@ def evaluate_hoi(dataset_file, model, postprocessors, data_loader, subject_categ
     preds = []
     gts = []
     for samples, targets in metric_logger.log_every(data_loader, 10, header):
-        samples = samples.to(device)
+        samples = samples.to(device, non_blocking=True, memory_format=memory_format)
 
         outputs = model(samples)
         orig_target_sizes = torch.stack([t["orig_size"] for t in targets], dim=0)
@@ -38,26 +38,21 @@ class PostProcessHOI(nn.Module):
         obj_boxes = box_ops.box_cxcywh_to_xyxy(out_obj_boxes)
         obj_boxes = obj_boxes * scale_fct[:, None, :]
 
-        results = []
-        for index in range(len(obj_scores)):
-            range(len(obj_scores))
-            os, ol, vs, sb, ob = obj_scores[index], obj_labels[index], verb_scores[index], sub_boxes[index], obj_boxes[
-                index]
-            sl = torch.full_like(ol, self.subject_category_id)
-            l = torch.cat((sl, ol))
-            b = torch.cat((sb, ob))
-            results.append({'labels': l.to('cpu'), 'boxes': b.to('cpu')})
-
-            vs = vs * os.unsqueeze(1)
-
-            if self.use_matching:
-                ms = matching_scores[index]
-                vs = vs * ms.unsqueeze(1)
-
-            ids = torch.arange(b.shape[0])
-
-            results[-1].update({'verb_scores': vs.to('cpu'), 'sub_ids': ids[:ids.shape[0] // 2],
-                                'obj_ids': ids[ids.shape[0] // 2:]})
+        # score all queries of the batch at once and copy to the host once,
+        # instead of per image and per tensor
+        verb_scores = verb_scores * obj_scores.unsqueeze(-1)
+        if self.use_matching:
+            verb_scores = verb_scores * matching_scores.unsqueeze(-1)
+        sub_labels = torch.full_like(obj_labels, self.subject_category_id)
+        labels = torch.cat((sub_labels, obj_labels), dim=1).to('cpu')
+        boxes = torch.cat((sub_boxes, obj_boxes), dim=1).to('cpu')
+        verb_scores = verb_scores.to('cpu')
+
+        num_queries = obj_labels.shape[1]
+        ids = torch.arange(2 * num_queries)
+        results = [{'labels': l, 'boxes': b, 'verb_scores': vs,
+                    'sub_ids': ids[:num_queries], 'obj_ids': ids[num_queries:]}
+                   for l, b, vs in zip(labels, boxes, verb_scores)]
 
         return results
 
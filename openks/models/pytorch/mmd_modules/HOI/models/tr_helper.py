@@ -1,13 +1,29 @@
 import copy
+import functools
+import inspect
 import torch
 import torch.nn as nn
 import torch.nn.functional as F
+from torch.utils.checkpoint import checkpoint
 
 
 def get_clones(module, N):
     return nn.ModuleList([copy.deepcopy(module) for i in range(N)])
 
 
+def non_reentrant_checkpoint_available():
+    """Non-reentrant checkpointing (use_reentrant=False) needs torch 1.11+"""
+    return 'use_reentrant' in inspect.signature(checkpoint).parameters
+
+
+def run_layer(layer, grad_checkpoint, *args, **kwargs):
+    """Call layer, recomputing its activations during backward if grad_checkpoint is set"""
+    if grad_checkpoint and layer.training and torch.is_grad_enabled():
+        # keyword arguments are bound beforehand, older torch versions do not forward them
+        return checkpoint(functools.partial(layer, **kwargs), *args, use_reentrant=False)
+    return layer(*args, **kwargs)
+
+
 def get_activation_fn(activation):
     """Return an activation function given a string"""
     if activation == "relu":
@@ -32,3 +48,54 @@ class MLP(nn.Module):
         for i, layer in enumerate(self.layers):
             x = F.relu(layer(x)) if i < self.num_layers - 1 else layer(x)
         return x
+
+
+class SDPAMultiheadAttention(nn.MultiheadAttention):
+    """nn.MultiheadAttention that computes attention with F.scaled_dot_product_attention,
+    so that PyTorch can dispatch to the fused flash / memory-efficient kernels.
+    Parameters are shared with the parent class, checkpoints stay compatible.
+    Attention weights are not materialized and None is returned instead."""
+
+    def forward(self, query, key, value, key_padding_mask=None,
+                need_weights=True, attn_mask=None, **kwargs):
+        if attn_mask is not None:
+            return super().forward(query, key, value, key_padding_mask=key_padding_mask,
+                                   need_weights=need_weights, attn_mask=attn_mask, **kwargs)
+
+        tgt_len, bsz, embed_dim = query.shape
+        src_len = key.shape[0]
+        head_dim = embed_dim // self.num_heads
+
+        w_q, w_k, w_v = self.in_proj_weight.chunk(3)
+        b_q = b_k = b_v = None
+        if self.in_proj_bias is not None:
+            b_q, b_k, b_v = self.in_proj_bias.chunk(3)
+        # [L, B, E] -> [B, nheads, L, head_dim]
+        q = F.linear(query, w_q, b_q).view(tgt_len, bsz, self.num_heads, head_dim).permute(1, 2, 0, 3)
+        k = F.linear(key, w_k, b_k).view(src_len, bsz, self.num_heads, head_dim).permute(1, 2, 0, 3)
+        v = F.linear(value, w_v, b_v).view(src_len, bsz, self.num_heads, head_dim).permute(1, 2, 0, 3)
+
+        mask = None
+        if key_padding_mask is not None:
+            # padding mask marks ignored keys, sdpa boolean mask marks attended ones
+            mask = ~key_padding_mask.to(torch.bool).view(bsz, 1, 1, src_len)
+
+        out = F.scaled_dot_product_attention(q, k, v, attn_mask=mask,
+                                             dropout_p=self.dropout if self.training else 0.)
+        out = out.permute(2, 0, 1, 3).reshape(tgt_len, bsz, embed_dim)
+        out = F.linear(out, self.out_proj.weight, self.out_proj.bias)
+        return out, None
+
+
+def use_sdpa_attention(model):
+    """Switch every plain nn.MultiheadAttention in model to SDPAMultiheadAttention.
+    Returns the number of replaced modules."""
+    if not hasattr(F, 'scaled_dot_product_attention'):
+        return 0
+    num_replaced = 0
+    for module in model.modules():
+        if type(module) is nn.MultiheadAttention and module._qkv_same_embed_dim \
+                and not getattr(module, 'batch_first', False):
+            module.__class__ = SDPAMultiheadAttention
+            num_replaced += 1
+    return num_replaced
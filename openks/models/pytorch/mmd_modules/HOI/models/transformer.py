@@ -3,7 +3,7 @@ from typing import Optional
 import torch
 from torch import nn, Tensor
 
-from .tr_helper import get_clones
+from .tr_helper import get_clones, run_layer, non_reentrant_checkpoint_available
 from .enc_helper import encoder_layer_builder
 from .dec_helper import decoder_layer_builder
 
@@ -28,7 +28,8 @@ class TransformerHOI(nn.Module):
                  normalize_before=False,
                  return_intermediate_dec=False,
                  split_query=False,
-                 interact_query=False):
+                 interact_query=False,
+                 grad_checkpoint=False):
         super().__init__()
 
         vanilla_encoder_layer = encoder_layer_builder('vanilla')(
@@ -47,6 +48,8 @@ class TransformerHOI(nn.Module):
         self.decoder = DecoderHOI(d_model, vanilla_decoder_layer, num_vanilla_decoders,
                                   hoi_decoder_layer, num_hoi_decoders, normalize_before, 
                                   return_intermediate=return_intermediate_dec, split_query=split_query)
+        # recompute the layer activations in backward instead of storing them
+        self.encoder.grad_checkpoint = self.decoder.grad_checkpoint = grad_checkpoint
 
         self._reset_parameters()
         self.d_model = d_model
@@ -93,6 +96,7 @@ class EncoderHOI(nn.Module):
         super().__init__()
         self.layers = get_clones(vanilla_encoder_layer, num_vanilla_layers)
         self.hoi_layers = get_clones(hoi_encoder_layer, num_hoi_layers)
+        self.grad_checkpoint = False
 
         self.norm = self.norm_sub = self.norm_obj = self.norm_verb = None
         if normalize_before:
@@ -111,14 +115,14 @@ class EncoderHOI(nn.Module):
                 pos: Optional[Tensor] = None):
         output = src
         for layer in self.layers:
-            output = layer(output, src_mask=mask, pos=pos,
-                           src_key_padding_mask=src_key_padding_mask)
+            output = run_layer(layer, self.grad_checkpoint, output, src_mask=mask, pos=pos,
+                               src_key_padding_mask=src_key_padding_mask)
         if self.norm is not None:
             output = self.norm(output)
 
         embed_sub = embed_obj = embed_verb = output
         for layer in self.hoi_layers:
-            embed_sub, embed_obj, embed_verb = layer(
+            embed_sub, embed_obj, embed_verb = run_layer(layer, self.grad_checkpoint,
                 embed_sub, embed_obj, embed_verb, src_mask=mask, pos=pos,
                 src_key_padding_mask=src_key_padding_mask)
         if self.norm_sub is not None:
@@ -139,6 +143,7 @@ class DecoderHOI(nn.Module):
 
         self.layers = get_clones(vanilla_decoder_layer, num_vanilla_layers)
         self.hoi_layers = get_clones(hoi_decoder_layer, num_hoi_layers)
+        self.grad_checkpoint = False
 
         self.norm = self.norm_sub1 = self.norm_obj1 = self.norm_verb1 = None
         self.norm_sub2 = self.norm_obj2 = self.norm_verb2 = None
@@ -170,23 +175,23 @@ class DecoderHOI(nn.Module):
         out_sub = out_obj = out_verb = tgt
         for layer_id, layer in enumerate(self.layers):
             if isinstance(layer, decoder_layer_builder('vanilla')):
-                out_sub = layer(out_sub, mem_sub, tgt_mask=tgt_mask,
-                                memory_mask=mem_mask,
-                                tgt_key_padding_mask=tgt_key_padding_mask,
-                                memory_key_padding_mask=mem_key_padding_mask,
-                                pos=pos, query_pos=query_pos)
-                out_obj = layer(out_obj, mem_obj, tgt_mask=tgt_mask,
-                                memory_mask=mem_mask,
-                                tgt_key_padding_mask=tgt_key_padding_mask,
-                                memory_key_padding_mask=mem_key_padding_mask,
-                                pos=pos, query_pos=query_pos)
-                out_verb = layer(out_verb, mem_verb, tgt_mask=tgt_mask,
-                                 memory_mask=mem_mask,
-                                 tgt_key_padding_mask=tgt_key_padding_mask,
-                                 memory_key_padding_mask=mem_key_padding_mask,
-                                 pos=pos, query_pos=query_pos)
+                out_sub = run_layer(layer, self.grad_checkpoint, out_sub, mem_sub, tgt_mask=tgt_mask,
+                                    memory_mask=mem_mask,
+                                    tgt_key_padding_mask=tgt_key_padding_mask,
+                                    memory_key_padding_mask=mem_key_padding_mask,
+                                    pos=pos, query_pos=query_pos)
+                out_obj = run_layer(layer, self.grad_checkpoint, out_obj, mem_obj, tgt_mask=tgt_mask,
+                                    memory_mask=mem_mask,
+                                    tgt_key_padding_mask=tgt_key_padding_mask,
+                                    memory_key_padding_mask=mem_key_padding_mask,
+                                    pos=pos, query_pos=query_pos)
+                out_verb = run_layer(layer, self.grad_checkpoint, out_verb, mem_verb, tgt_mask=tgt_mask,
+                                     memory_mask=mem_mask,
+                                     tgt_key_padding_mask=tgt_key_padding_mask,
+                                     memory_key_padding_mask=mem_key_padding_mask,
+                                     pos=pos, query_pos=query_pos)
             else:
-                out_sub, out_obj, out_verb = layer(
+                out_sub, out_obj, out_verb = run_layer(layer, self.grad_checkpoint,
                     out_sub, out_obj, out_verb, mem_sub, mem_obj, mem_verb,
                     tgt_mask=tgt_mask, memory_mask=mem_mask, tgt_key_padding_mask=tgt_key_padding_mask,
                     memory_key_padding_mask=mem_key_padding_mask, pos=pos, query_pos=query_pos)
@@ -213,21 +218,21 @@ class DecoderHOI(nn.Module):
         if isinstance(self.hoi_layers[0], decoder_layer_builder('vanilla')):
             for dec_sub, dec_obj, dec_verb in zip(
                     self.hoi_layers[::3], self.hoi_layers[1::3], self.hoi_layers[2::3]):
-                out_sub = dec_sub(out_sub, mem_sub, tgt_mask=tgt_mask,
-                                  memory_mask=mem_mask,
-                                  tgt_key_padding_mask=tgt_key_padding_mask,
-                                  memory_key_padding_mask=mem_key_padding_mask,
-                                  pos=pos, query_pos=query_pos)
-                out_obj = dec_obj(out_obj, mem_obj, tgt_mask=tgt_mask,
-                                  memory_mask=mem_mask,
-                                  tgt_key_padding_mask=tgt_key_padding_mask,
-                                  memory_key_padding_mask=mem_key_padding_mask,
-                                  pos=pos, query_pos=query_pos)
-                out_verb = dec_verb(out_verb, mem_verb, tgt_mask=tgt_mask,
+                out_sub = run_layer(dec_sub, self.grad_checkpoint, out_sub, mem_sub, tgt_mask=tgt_mask,
+                                    memory_mask=mem_mask,
+                                    tgt_key_padding_mask=tgt_key_padding_mask,
+                                    memory_key_padding_mask=mem_key_padding_mask,
+                                    pos=pos, query_pos=query_pos)
+                out_obj = run_layer(dec_obj, self.grad_checkpoint, out_obj, mem_obj, tgt_mask=tgt_mask,
                                     memory_mask=mem_mask,
                                     tgt_key_padding_mask=tgt_key_padding_mask,
                                     memory_key_padding_mask=mem_key_padding_mask,
                                     pos=pos, query_pos=query_pos)
+                out_verb = run_layer(dec_verb, self.grad_checkpoint, out_verb, mem_verb, tgt_mask=tgt_mask,
+                                     memory_mask=mem_mask,
+                                     tgt_key_padding_mask=tgt_key_padding_mask,
+                                     memory_key_padding_mask=mem_key_padding_mask,
+                                     pos=pos, query_pos=query_pos)
                 if self.return_intermediate:
                     if self.norm_sub2 is not None:
                         intermediate.append((
@@ -236,7 +241,7 @@ class DecoderHOI(nn.Module):
                         intermediate.append((out_sub, out_obj, out_verb))
         else:
             for layer in self.hoi_layers:
-                out_sub, out_obj, out_verb = layer(
+                out_sub, out_obj, out_verb = run_layer(layer, self.grad_checkpoint,
                     out_sub, out_obj, out_verb, mem_sub, mem_obj, mem_verb,
                     tgt_mask=tgt_mask, memory_mask=mem_mask, tgt_key_padding_mask=tgt_key_padding_mask,
                     memory_key_padding_mask=mem_key_padding_mask, pos=pos, query_pos=query_pos)
@@ -285,6 +290,8 @@ class DecoderHOI(nn.Module):
 
 
 def build_transformer(args):
+    if args.grad_checkpoint and not non_reentrant_checkpoint_available():
+        raise ValueError('--grad_checkpoint requires torch >= 1.11 (non-reentrant torch.utils.checkpoint)')
     if args.hoi:
         return TransformerHOI(
             d_model=args.hidden_dim,
@@ -303,6 +310,7 @@ def build_transformer(args):
             normalize_before=args.pre_norm,
             return_intermediate_dec=True,
             split_query=args.split_query,
-            interact_query=args.interact_query)
+            interact_query=args.interact_query,
+            grad_checkpoint=args.grad_checkpoint)
 
     raise ValueError('not implement!')
@@ -4,13 +4,16 @@ Misc functions, including distributed helpers.
 Mostly copy-paste from torchvision references.
 """
 import os
+import random
 import subprocess
 import time
 from collections import defaultdict, deque
 import datetime
+import json
 import pickle
 from typing import Optional, List
 
+import numpy as np
 import torch
 import torch.distributed as dist
 from torch import Tensor
@@ -270,6 +273,16 @@ def collate_fn(batch):
     return tuple(batch)
 
 
+def seed_worker(worker_id):
+    """
+    worker_init_fn seeding numpy and random from the per-worker torch seed,
+    which the DataLoader derives from its generator and the worker id.
+    """
+    worker_seed = torch.initial_seed() % 2 ** 32
+    np.random.seed(worker_seed)
+    random.seed(worker_seed)
+
+
 def _max_by_axis(the_list):
     # type: (List[List[int]]) -> List[int]
     maxes = the_list[0]
@@ -304,17 +317,26 @@ class NestedTensor(object):
         self.tensors = tensors
         self.mask = mask
 
-    def to(self, device):
-        # type: (Device) -> NestedTensor # noqa
-        cast_tensor = self.tensors.to(device)
+    def to(self, device, non_blocking=False, memory_format=torch.preserve_format):
+        # type: (Device, bool, torch.memory_format) -> NestedTensor # noqa
+        cast_tensor = self.tensors.to(device, non_blocking=non_blocking, memory_format=memory_format)
         mask = self.mask
         if mask is not None:
             assert mask is not None
-            cast_mask = mask.to(device)
+            cast_mask = mask.to(device, non_blocking=non_blocking)
         else:
             cast_mask = None
         return NestedTensor(cast_tensor, cast_mask)
 
+    def pin_memory(self):
+        # picked up by the DataLoader pin_memory thread, without it the batch stays pageable
+        return NestedTensor(self.tensors.pin_memory(), self.mask.pin_memory() if self.mask is not None else None)
+
+    def record_stream(self, stream):
+        self.tensors.record_stream(stream)
+        if self.mask is not None:
+            self.mask.record_stream(stream)
+
     def decompose(self):
         return self.tensors, self.mask
 
@@ -322,6 +344,62 @@ class NestedTensor(object):
         return str(self.tensors)
 
 
+class CUDAPrefetcher(object):
+    """Wrap a data loader so that the host-to-device copy of the next batch is
+    issued on a side CUDA stream while the current batch is being consumed.
+    """
+
+    def __init__(self, loader, device, memory_format=torch.preserve_format):
+        self.loader = loader
+        self.device = device
+        self.memory_format = memory_format
+        self.stream = torch.cuda.Stream(device=device)
+        self._iter = None
+        self.next_samples = self.next_targets = None
+
+    def __len__(self):
+        return len(self.loader)
+
+    def __iter__(self):
+        self._iter = iter(self.loader)
+        self.preload()
+        return self
+
+    def __next__(self):
+        batch = self.next()
+        if batch is None:
+            raise StopIteration
+        return batch
+
+    def preload(self):
+        try:
+            samples, targets = next(self._iter)
+        except StopIteration:
+            self.next_samples = self.next_targets = None
+            return
+        # the copy only overlaps with compute if the loader hands out pinned batches
+        # (pin_memory=True, see NestedTensor.pin_memory), otherwise the host blocks on it
+        with torch.cuda.stream(self.stream):
+            self.next_samples = samples.to(self.device, non_blocking=True, memory_format=self.memory_format)
+            self.next_targets = [{k: v.to(self.device, non_blocking=True) for k, v in t.items()}
+                                 for t in targets]
+
+    def next(self):
+        current_stream = torch.cuda.current_stream()
+        current_stream.wait_stream(self.stream)
+        samples, targets = self.next_samples, self.next_targets
+        if samples is None:
+            return None
+        # the tensors were allocated on the side stream, tell the caching
+        # allocator they are now in use on the compute stream as well
+        samples.record_stream(current_stream)
+        for t in targets:
+            for v in t.values():
+                v.record_stream(current_stream)
+        self.preload()
+        return samples, targets
+
+
 def setup_for_distributed(is_master):
     """
     This function disables printing when not in master process
@@ -474,7 +552,7 @@ def save_checkpoints(args, output_dir, recorder, epoch, test_stats,
         checkpoint_paths = [output_dir / 'checkpoint.pth']
 
         # save best metrics
-        if recorder is not None and recorder.is_best(test_stats, epoch):
+        if recorder is not None and test_stats and recorder.is_best(test_stats, epoch):
             checkpoint_paths.append(output_dir / 'checkpoint_best.pth')
             if hoi_evaluator is not None:
                 hoi_evaluator.save_best_prediction(output_dir)
@@ -482,14 +560,21 @@ def save_checkpoints(args, output_dir, recorder, epoch, test_stats,
         if (epoch + 1) % args.lr_drop == 0 or (epoch + 1) % 100 == 0:
             checkpoint_paths.append(output_dir / f'checkpoint{epoch:04}.pth')
 
+        # a sharded optimizer (ZeroRedundancyOptimizer) has to gather its state
+        # on the saving rank first, this must be called on every rank
+        if hasattr(optimizer, 'consolidate_state_dict'):
+            optimizer.consolidate_state_dict(to=0)
+        optimizer_state = optimizer.state_dict() if is_main_process() else None
+
         for checkpoint_path in checkpoint_paths:
             save_dict = {
                 'model': model_without_ddp.state_dict(),
-                'optimizer': optimizer.state_dict(),
-                'lr_scheduler': lr_scheduler.state_dict(),
+                'optimizer': optimizer_state,
                 'epoch': epoch,
                 'args': args,
             }
+            if lr_scheduler is not None:
+                save_dict['lr_scheduler'] = lr_scheduler.state_dict()
             if recorder is not None:
                 best_epoch, best_metrics = recorder.get_best_metrics()
                 save_dict.update({